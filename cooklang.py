@@ -1,11 +1,50 @@
-import itertools
 import re
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, replace
+from functools import lru_cache
 from fractions import Fraction
-from typing import Mapping, Optional, Sequence, Tuple, Union, List
+from typing import (
+    Dict,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Pattern,
+    Sequence,
+    Tuple,
+    Union,
+    List,
+)
 
+# lines may end in \n, \r\n or \r, the same boundaries str.splitlines uses
+# for the common line endings. every alternative is deterministic so the
+# sweep stays linear: brace contents can't contain another brace, and block
+# comments only match their opening "[-", the closing "-]" on the same line
+# is looked up with str.find by the caller instead of a backtracking ".*?".
+# comments inside braces are part of the brace token, the caller removes them
+# with _strip_brace_comments
+_TOKEN_RE: Pattern[str] = re.compile(
+    r"(?P<blockcmt>\[-)"
+    r"|(?P<linecmt>--[^\r\n]+)"
+    r"|(?P<meta>>>)"
+    r"|(?P<ingr>@(?:\w[\w ]*\{[^{}\r\n]*\}|\w+))"
+    r"|(?P<cook>#(?P<cookname>\w[\w ]*(?=\{[^{}\r\n]*\})|\w+)"
+    r"(?:\{[^{}\r\n]*\})?)"
+    r"|(?P<timer>~(?P<timername>[\w ]*(?=\{[^{}\r\n]*\})|\w+)"
+    r"(?:\{(?P<timerbody>[^{}\r\n]*)\})?)"
+    r"|(?P<nl>\r\n?|\n)"
+)
+_TIMER_PARSE_RE: Pattern[str] = re.compile(
+    r"^~([^{]*)(?:\{([^}]*)\})?",
+)
+_METADATA_RE: Pattern[str] = re.compile(r"^>> ?([^:]+): ?(.*)$")
 
-@dataclass
+# slots=True is only accepted by dataclass() from python 3.10 onwards
+_SLOTS: Dict[str, bool] = {}
+if sys.version_info >= (3, 10):
+    _SLOTS["slots"] = True
+
+
+@dataclass(frozen=True, **_SLOTS)
 class Quantity:
     amount: Union[int, float, Fraction]
     unit: Optional[str] = None
@@ -14,16 +53,16 @@ class Quantity:
     def add_optional(
         cls, a: Optional["Quantity"], b: Optional["Quantity"]
     ) -> Optional["Quantity"]:
-        if a and b:
-            return a + b
-        elif a or b:
-            return a or b
-        return None
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a + b
 
     def __add__(self, other: "Quantity") -> "Quantity":
         if self.unit != other.unit:
             raise ValueError(f"Cannot add unit {self.unit} to {other.unit}")
-        if type(self.amount) != type(other.amount):  # noqa: E721
+        if type(self.amount) is not type(other.amount):
             raise ValueError(
                 "Cannot add quantities with types "
                 + f"{type(self.amount)} and {type(other.amount)}"
@@ -38,16 +77,18 @@ class Quantity:
         )
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Timer:
     name: str
     quantity: Optional[Quantity] = None
 
     @classmethod
     def parse(cls, raw: str) -> "Timer":
-        name, raw_amount = re.findall(r"^~([^{]*)(?:{([^}]*)})?", raw)[0]
-        matches = re.findall(r"([^%}]+)%?([\w]+)?", raw_amount)
-        return Timer(name, _get_quantity(matches))
+        match = _TIMER_PARSE_RE.match(raw)
+        if match is None:
+            raise ValueError(f"Invalid timer {raw}")
+        name, body = match.groups()
+        return Timer(name, _parse_timer_body(body)[2])
 
     def __add__(self, other: "Timer") -> "Timer":
         if self.name != other.name:
@@ -60,7 +101,7 @@ class Timer:
         )
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Ingredient:
     name: str
     location: Tuple[int, int, int]
@@ -69,32 +110,12 @@ class Ingredient:
     @classmethod
     def parse(
         cls,
-        match: re.Match,
-        step_index: int,
-        steps: List[str],
-        current_ingredients: List,
+        name: str,
+        raw_amount: str,
+        location: Tuple[int, int, int],
     ) -> "Ingredient":
-        raw = match.group()
-        name, raw_amount = re.findall(r"^@([^{]+)(?:{([^}]*)})?", raw)[0]
-        matches = re.findall(r"([^%}]+)%?([\w]+)?", raw_amount)
-
-        # get the location of the ingredient in the step str. we do this by searching the current step, but only after the end of the last ingredient's location.
-        ingredients_on_current_step = [
-            i for i in current_ingredients if i.location[0] == step_index
-        ]
-        last_ingr_index = (
-            ingredients_on_current_step[-1].location[2]
-            if len(ingredients_on_current_step) > 0
-            else 0
-        )
-        location_match = re.search(name, steps[step_index][last_ingr_index:])
-        location = (
-            step_index,
-            location_match.start() + last_ingr_index,
-            location_match.end() + last_ingr_index,
-        )
-
-        return Ingredient(name, location, _get_quantity(matches))
+        amount, _, unit = raw_amount.partition("%")
+        return Ingredient(name, location, _make_quantity(amount, unit))
 
     def __add__(self, other: "Ingredient") -> "Ingredient":
         if self.name != other.name:
@@ -108,7 +129,7 @@ class Ingredient:
         )
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Recipe:
     metadata: Mapping[str, str]
     ingredients: Sequence[Ingredient]
@@ -118,127 +139,247 @@ class Recipe:
 
     @classmethod
     def parse(cls, raw: str) -> "Recipe":
-        raw_without_comments = re.sub(r"(--[^\n]+|\[-.*-\])", "", raw)
-        raw_paragraphs = list(
-            filter(None, map(str.strip, raw_without_comments.split("\n")))
-        )
-
-        raw_steps = list(
-            filter(
-                lambda x: not x.startswith(">>"),
-                raw_paragraphs,
-            )
-        )
-        steps = [
-            re.sub(
-                r"(?:@|#)(\w[\w ]*)({[^}]*})?",
-                r"\1",
-                re.sub(
-                    r"~[\w ]*\{([^}%]*)(?:%([^}]+))?}",
-                    r"\1 \2",
-                    raw_step,
-                ),
-            )
-            for raw_step in raw_steps
-        ]
-
-        ingr_pat = re.compile("@(?:(?:[\w ]+?){[^}]*}|[\w]+)")
-        ingredients = []
-        for raw_step_index, raw_step in enumerate(raw_steps):
-            for ingr_match in ingr_pat.finditer(raw_step):
-                ingredients.append(
-                    Ingredient.parse(ingr_match, raw_step_index, steps, ingredients)
-                )
-
-        cookware = list(
-            itertools.chain(
-                *map(
-                    lambda raw_step: list(
-                        map(
-                            lambda s: s[1] or s[0],
-                            re.findall(
-                                r"#(([\w ]+?){[^}]*}|[\w]+)",
-                                raw_step,
-                            ),
-                        )
-                    ),
-                    raw_steps,
-                )
-            )
-        )
-        timers = list(
-            itertools.chain(
-                *map(
-                    lambda raw_step: list(
-                        map(
-                            lambda s: Timer.parse(s),
-                            re.findall(
-                                r"~(?:(?:[\w ]*?){[^}]*}|[\w]+)",
-                                raw_step,
-                            ),
-                        )
-                    ),
-                    raw_steps,
-                )
-            )
-        )
-
-        def _remove_duplicates(
-            ingredients: Sequence[Ingredient],
-        ) -> Sequence[Ingredient]:
-            name_to_ingredient = {}
-            added_ingredients = set()
-            for i in ingredients:
-                if i.name not in name_to_ingredient.keys():
-                    name_to_ingredient[i.name] = i
-                else:
-                    name_to_ingredient[i.name] += i
-                added_ingredients.add(i.name)
-            return list(name_to_ingredient.values())
-
-        ingredients = _remove_duplicates(ingredients)
-
-        def _extract_metadata(raw_line: str) -> Optional[Tuple[str, str]]:
-            res = re.search(r"^>> ?([^:]+): ?(.*)$", raw_line)
-            if not res:
-                return None
-            return (res.group(1).strip(), res.group(2).strip())
-
-        raw_metadata = list(
-            filter(
-                lambda x: x.startswith(">>"),
-                raw_paragraphs,
-            )
-        )
-        metadata = dict(
-            filter(
-                None,
-                (_extract_metadata(raw_line) for raw_line in raw_metadata),
-            )
-        )
-
+        metadata, steps, ingredients, cookware, timers = _scan_tokens(raw)
         return Recipe(
             metadata=metadata,
-            ingredients=ingredients,
+            ingredients=_remove_duplicates(ingredients),
             cookware=cookware,
             timers=timers,
             steps=steps,
         )
 
 
-def _get_quantity(matches: Sequence[Sequence[str]]) -> Optional[Quantity]:
-    if not matches:
-        return None
+# parsing is pure, so repeated parses of the same recipe (e.g. re-rendering a
+# preview) can skip the tokenizer. every call gets its own containers and
+# ingredient/timer objects, so mutating a result can't corrupt the cached one;
+# quantities are frozen and everything else is a str or tuple, so those are
+# shared
+def parse_cached(raw: str) -> Recipe:
+    recipe = _parse_cached(raw)
+    return Recipe(
+        metadata=dict(recipe.metadata),
+        ingredients=[replace(i) for i in recipe.ingredients],
+        steps=list(recipe.steps),
+        cookware=list(recipe.cookware),
+        timers=[replace(t) for t in recipe.timers],
+    )
+
+
+@lru_cache(maxsize=256)
+def _parse_cached(raw: str) -> Recipe:
+    return Recipe.parse(raw)
+
+
+class _Scan(NamedTuple):
+    metadata: Dict[str, str]
+    steps: List[str]
+    ingredients: List[Ingredient]
+    cookware: List[str]
+    timers: List[Timer]
+
+
+def _scan_tokens(raw: str) -> _Scan:
+    metadata: Dict[str, str] = {}
+    steps: List[str] = []
+    ingredients: List[Ingredient] = []
+    cookware: List[str] = []
+    timers: List[Timer] = []
+
+    # single sweep over the raw text: literal text between tokens and the
+    # cleaned form of each token are accumulated into the current step,
+    # which gets flushed (and stripped) at every newline. step_len tracks
+    # the length of the cleaned step so far, which gives us the location
+    # of each ingredient without having to search for it afterwards. lines
+    # starting with ">>" are collected verbatim (minus comments) instead and
+    # parsed as metadata when they end
+    current_step: List[str] = []
+    step_len = 0
+    pending = ""
+    in_metadata = False
+    line_end = -1
+    block_end = 0
+    next_cr = 0
+    next_nl = 0
+    pos = 0
+    raw += "\n"
+    while True:
+        match = _TOKEN_RE.search(raw, pos)
+        if match is None:
+            break
+        start = match.start()
+        pending += raw[pos:start]
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "blockcmt":
+            # block comments can't span lines, so the closing "-]" is only
+            # searched for up to the end of the current line. every lookup
+            # is reused while it is still ahead of us, and once a line has
+            # no "-]" left we stop looking on it, otherwise many unclosed
+            # "[-" (or many \r-only lines) would make this quadratic
+            if line_end < pos:
+                if next_cr != -1 and next_cr < pos:
+                    next_cr = raw.find("\r", pos)
+                # raw ends with "\n", so this always finds one
+                if next_nl < pos:
+                    next_nl = raw.find("\n", pos)
+                line_end = next_nl
+                if next_cr != -1 and next_cr < line_end:
+                    line_end = next_cr
+            if block_end != -1 and block_end < pos:
+                block_end = raw.find("-]", pos, line_end)
+            if block_end == -1:
+                pending += "["
+                pos = start + 1
+            else:
+                pos = block_end + 2
+            continue
+        if kind == "linecmt":
+            continue
+        if kind == "nl":
+            if in_metadata:
+                res = _METADATA_RE.match((">>" + pending).rstrip())
+                if res:
+                    metadata[res.group(1).strip()] = res.group(2).strip()
+                in_metadata = False
+            elif current_step:
+                current_step.append(pending.rstrip())
+            else:
+                pending = pending.strip()
+                if pending:
+                    current_step.append(pending)
+            if current_step:
+                steps.append("".join(current_step))
+                current_step = []
+                step_len = 0
+            pending = ""
+            line_end = -1
+            block_end = 0
+            continue
+        if in_metadata:
+            pending += _strip_brace_comments(match.group())
+            continue
+        if kind == "meta":
+            if current_step or pending.strip():
+                pending += ">>"
+            else:
+                in_metadata = True
+                pending = ""
+            continue
+
+        if not current_step:
+            pending = pending.lstrip()
+        if pending:
+            current_step.append(pending)
+            step_len += len(pending)
+            pending = ""
+        token = match.group()
+        if kind == "ingr":
+            token = _strip_brace_comments(token)
+            name, _, raw_amount = token[1:].partition("{")
+            raw_amount = raw_amount.rstrip("}")
+            location = (len(steps), step_len, step_len + len(name))
+            ingredients.append(Ingredient.parse(name, raw_amount, location))
+            current_step.append(name)
+        elif kind == "cook":
+            name = match.group("cookname")
+            cookware.append(name)
+            current_step.append(name)
+        else:
+            # the timer and its text in the step come from the same match.
+            # timers without an amount, or with an empty unit after the "%",
+            # are left as they were written
+            name = match.group("timername")
+            body = match.group("timerbody")
+            amount, unit, quantity = _parse_timer_body(body)
+            timers.append(Timer(name, quantity))
+            if amount is None or unit == "":
+                current_step.append(_strip_brace_comments(token))
+            else:
+                current_step.append(f"{amount} {unit or ''}")
+        step_len += len(current_step[-1])
+
+    return _Scan(metadata, steps, ingredients, cookware, timers)
+
+
+def _parse_timer_body(
+    body: Optional[str],
+) -> Tuple[Optional[str], Optional[str], Optional[Quantity]]:
+    # shared by Timer.parse and the sweep. the raw amount and unit are
+    # returned along with the quantity since the sweep writes them into the
+    # step; unit is None without a "%" and "" with an empty one
+    if body is None:
+        return None, None, None
+    amount, percent, unit = _strip_brace_comments(body).partition("%")
+    unit_or_none = unit if percent else None
+    return amount, unit_or_none, _make_quantity(amount, unit_or_none)
+
+
+def _strip_brace_comments(text: str) -> str:
+    # the contents of a brace token can't contain braces or newlines, so a
+    # "--" comment in there runs up to the closing brace. like in the sweep,
+    # a "[-" without a closing "-]" is kept as is, and once one is found
+    # later "[-" can't be closed either, so we stop looking for block
+    # comments (but not for "--"), which keeps this linear
+    if "-" not in text:
+        return text
+    parts: List[str] = []
+    pos = 0
+    line_cmt = text.find("--")
+    block_cmt = text.find("[-")
+    while True:
+        if line_cmt != -1 and (block_cmt == -1 or line_cmt < block_cmt):
+            # drop the comment but keep the closing brace, if this is a token
+            end = len(text) - 1 if text.endswith("}") else len(text)
+            parts.append(text[pos:line_cmt])
+            pos = end
+            break
+        if block_cmt == -1:
+            break
+        block_end = text.find("-]", block_cmt + 2)
+        if block_end == -1:
+            block_cmt = -1
+            continue
+        parts.append(text[pos:block_cmt])
+        pos = block_end + 2
+        block_cmt = text.find("[-", pos)
+        if line_cmt != -1 and line_cmt < pos:
+            line_cmt = text.find("--", pos)
+    parts.append(text[pos:])
+    return "".join(parts)
+
+
+def _remove_duplicates(ingredients: Sequence[Ingredient]) -> List[Ingredient]:
+    name_to_ingredient: Dict[str, Ingredient] = {}
+    for i in ingredients:
+        prev = name_to_ingredient.get(i.name)
+        if prev is None:
+            name_to_ingredient[i.name] = i
+        else:
+            # merge in place rather than going through __add__, which
+            # would re-check the names and build a new Ingredient
+            prev.quantity = Quantity.add_optional(prev.quantity, i.quantity)
+    return list(name_to_ingredient.values())
+
 
-    match = matches[0]
-    amount_as_str = match[0]
+def _make_quantity(
+    amount_as_str: Optional[str], unit: Optional[str]
+) -> Optional[Quantity]:
+    # cooklang allows spaces around the "%", e.g. {1 % cup}
+    amount_as_str = (amount_as_str or "").strip()
     if not amount_as_str:
         return None
+    unit = unit.strip() if unit else None
     if "." in amount_as_str:
         amount = float(amount_as_str)
-    elif "/" in amount_as_str:
-        amount = Fraction(amount_as_str)
     else:
-        amount = int(amount_as_str)
-    unit = str(match[1]) if match[1] else None
-    return Quantity(amount, unit)
+        # a single partition both detects and splits fractions, and building
+        # the Fraction from ints skips the regex Fraction(str) goes through
+        numerator, slash, denominator = amount_as_str.partition("/")
+        if slash:
+            amount = Fraction(int(numerator), int(denominator))
+        else:
+            amount = int(amount_as_str)
+    # units repeat a lot ("grams", "cup", ...), interning them saves memory
+    # and lets the unit comparison in Quantity.__add__ short-circuit on
+    # identity
+    return Quantity(amount, sys.intern(unit) if unit else None)
@@ -1,10 +1,11 @@
 from fractions import Fraction
 from inspect import cleandoc
+from typing import Dict, List, cast
 import unittest
 
 from pyexpect import expect
 
-from cooklang import Ingredient, Quantity, Recipe, Timer
+from cooklang import Ingredient, Quantity, Recipe, Timer, parse_cached
 
 
 class ParserTest(unittest.TestCase):
@@ -64,6 +65,22 @@ class ParserTest(unittest.TestCase):
             ]
         )
 
+    def test_units_with_spaces(self) -> None:
+        recipe = Recipe.parse("Add @milk{1%fl oz} and wait ~{2%half hours}")
+        expect(recipe.ingredients).to_equal(
+            [Ingredient("milk", (0, 4, 8), Quantity(1, "fl oz"))]
+        )
+        expect(recipe.timers).to_equal([Timer("", Quantity(2, "half hours"))])
+        expect(recipe.steps).to_equal(["Add milk and wait 2 half hours"])
+
+        recipe = Recipe.parse(
+            "Add @sugar{1 % cup} and @sugar{2%cup}, wait ~{10% minutes}"
+        )
+        expect(recipe.ingredients).to_equal(
+            [Ingredient("sugar", (0, 4, 9), Quantity(3, "cup"))]
+        )
+        expect(recipe.timers).to_equal([Timer("", Quantity(10, "minutes"))])
+
     def test_adding_up_ingredient_quantities(self) -> None:
         recipe = Recipe.parse(
             cleandoc(
@@ -142,6 +159,19 @@ class ParserTest(unittest.TestCase):
         expect(recipe.ingredients).to_equal([])
         expect(recipe.steps).to_equal([])
 
+    def test_line_endings(self) -> None:
+        recipe = Recipe.parse(
+            "Boil the @water\r\n>> time: 5 mins\r\nAdd @salt\rServe -- hot\n"
+        )
+        expect(recipe.metadata).to_equal({"time": "5 mins"})
+        expect(recipe.ingredients).to_equal(
+            [
+                Ingredient("water", (0, 9, 14)),
+                Ingredient("salt", (1, 4, 8)),
+            ]
+        )
+        expect(recipe.steps).to_equal(["Boil the water", "Add salt", "Serve"])
+
     def test_stripping_out_comments(self) -> None:
         recipe = Recipe.parse(
             cleandoc(
@@ -171,6 +201,74 @@ class ParserTest(unittest.TestCase):
             ]
         )
 
+    def test_multiple_block_comments(self) -> None:
+        recipe = Recipe.parse(
+            cleandoc(
+                """
+            Add [- not yet -] @salt [- or pepper -] to taste
+            [- quick -]>> time: 5 mins
+            Leave [- this open
+        """
+            )
+        )
+        expect(recipe.metadata).to_equal({"time": "5 mins"})
+        expect(recipe.ingredients).to_equal([Ingredient("salt", (0, 5, 9))])
+        expect(recipe.steps).to_equal(
+            [
+                "Add  salt  to taste",
+                "Leave [- this open",
+            ]
+        )
+
+    def test_block_comments_stay_on_their_line(self) -> None:
+        recipe = Recipe.parse(
+            cleandoc(
+                """
+            >> title: foo [- x
+            Leave [- open
+            @salt{1%g}
+            final -] x
+            more @pepper
+        """
+            )
+        )
+        expect(recipe.metadata).to_equal({"title": "foo [- x"})
+        expect(recipe.ingredients).to_equal(
+            [
+                Ingredient("salt", (1, 0, 4), Quantity(1, "g")),
+                Ingredient("pepper", (3, 5, 11)),
+            ]
+        )
+        expect(recipe.steps).to_equal(
+            [
+                "Leave [- open",
+                "salt",
+                "final -] x",
+                "more pepper",
+            ]
+        )
+
+    def test_block_comments_stay_on_their_line_with_cr(self) -> None:
+        recipe = Recipe.parse(
+            ">> title: foo [- x\rLeave [- open\r@salt{1%g}\rfinal -] x\r"
+            + "more [- gone -] @pepper"
+        )
+        expect(recipe.metadata).to_equal({"title": "foo [- x"})
+        expect(recipe.ingredients).to_equal(
+            [
+                Ingredient("salt", (1, 0, 4), Quantity(1, "g")),
+                Ingredient("pepper", (3, 6, 12)),
+            ]
+        )
+        expect(recipe.steps).to_equal(
+            [
+                "Leave [- open",
+                "salt",
+                "final -] x",
+                "more  pepper",
+            ]
+        )
+
     def test_stripping_out_timing(self) -> None:
         recipe = Recipe.parse(
             cleandoc(
@@ -191,6 +289,51 @@ class ParserTest(unittest.TestCase):
             ]
         )
 
+    def test_comments_inside_braces(self) -> None:
+        recipe = Recipe.parse(
+            cleandoc(
+                """
+            Add @flour{200 [- about -]%g} and @sugar{50%g [- sifted -]}
+            Bake ~{20%minutes -- or until golden} in the #oven{[- hot -]}
+        """
+            )
+        )
+        expect(recipe.ingredients).to_equal(
+            [
+                Ingredient("flour", (0, 4, 9), Quantity(200, "g")),
+                Ingredient("sugar", (0, 14, 19), Quantity(50, "g")),
+            ]
+        )
+        expect(recipe.timers).to_equal(
+            [Timer("", Quantity(20, "minutes"))],
+        )
+        expect(recipe.cookware).to_equal(["oven"])
+        expect(recipe.steps).to_equal(
+            [
+                "Add flour and sugar",
+                "Bake 20 minutes  in the oven",
+            ]
+        )
+
+    def test_unclosed_block_comment_inside_braces(self) -> None:
+        recipe = Recipe.parse(
+            cleandoc(
+                """
+            Add @flour{200%g [- x -- y}
+            Bake ~{20%min [-- golden}
+        """
+            )
+        )
+        expect(recipe.ingredients).to_equal(
+            [Ingredient("flour", (0, 4, 9), Quantity(200, "g [- x"))],
+        )
+        expect(recipe.timers).to_equal([Timer("", Quantity(20, "min ["))])
+        expect(recipe.steps).to_equal(["Add flour", "Bake 20 min ["])
+
+    def test_timer_parse_matches_recipe_parse(self) -> None:
+        for raw in ["~{20%minutes -- golden}", "~{5%}", "~eggs{3 % min}"]:
+            expect(Timer.parse(raw)).to_equal(Recipe.parse(raw).timers[0])
+
     def test_skip_invalid_syntax(self) -> None:
         recipe = Recipe.parse(
             cleandoc(
@@ -280,6 +423,39 @@ class ParserTest(unittest.TestCase):
             ]
         )
 
+    def test_ingredient_location_after_matching_text(self) -> None:
+        recipe = Recipe.parse(
+            cleandoc(
+                """
+            Grab the #pepper mill{} and grind some @pepper
+        """
+            )
+        )
+        expect(recipe.ingredients).to_equal(
+            [
+                Ingredient("pepper", (0, 36, 42)),
+            ]
+        )
+        expect(recipe.steps).to_equal(
+            [
+                "Grab the pepper mill and grind some pepper",
+            ]
+        )
+
+    def test_parse_cached(self) -> None:
+        raw = "Boil @water{1%l} for ~{10%minutes}"
+        recipe = parse_cached(raw)
+        expect(recipe).to_equal(Recipe.parse(raw))
+
+        # mutating one result must not leak into later ones
+        recipe.ingredients[0].quantity = None
+        recipe.timers[0].name = "junk"
+        junk = Ingredient("junk", (0, 0, 0))
+        cast(List[Ingredient], recipe.ingredients).append(junk)
+        cast(List[str], recipe.steps).clear()
+        cast(Dict[str, str], recipe.metadata)["junk"] = "yes"
+        expect(parse_cached(raw)).to_equal(Recipe.parse(raw))
+
 
 if __name__ == "__main__":
     unittest.main()